@@ -2,34 +2,45 @@ import os
 import asyncio
 import logging
 import sys
-import aiohttp
+from aiohttp import web
 import aiofiles
+import aiofiles.os
 from dotenv import load_dotenv
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.enums import ParseMode, MessageMediaType
-from pyrogram.errors import FloodWait, RPCError
-import json
+from pyrogram.errors import FloodWait
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+import tempfile
+import collections
 import concurrent.futures
-import hashlib
-import psutil
-from flask import Flask, jsonify
+import functools
+import sqlite3
 import threading
-import uvloop
-from PIL import Image
-import io
+import weakref
+import atexit
+import mmap
 import re
-import schedule
-import asyncio
+import string
+try:
+    import uvloop
+except ImportError:  # e.g. Windows or interpreters without a uvloop build
+    uvloop = None
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+    import json
 
 # ULTRA SPEED CONFIGURATION
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # MAXIMUM PERFORMANCE OPTIMIZATION
-asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+# Create the one event loop up front so the Pyrogram client below binds to it
+event_loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+asyncio.set_event_loop(event_loop)
 
 load_dotenv()
 
@@ -40,10 +51,27 @@ API_HASH = os.getenv("API_HASH", "")
 
 # ULTRA SPEED SETTINGS
 MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024  # 4GB
-CHUNK_SIZE = 512 * 1024  # 512KB
-MAX_WORKERS = 200
+CHUNK_SIZE = 4 * 1024 * 1024  # 4MB disk write batch per download segment
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 200))  # handler tasks; each rename holds one for its whole transfer
 BUFFER_SIZE = 64 * 1024  # 64KB BUFFER
+STREAM_CHUNK_SIZE = 1024 * 1024  # Pyrogram stream_media part size
+DOWNLOAD_SEGMENTS = 4  # parallel stream_media connections per download
+IN_MEMORY_LIMIT = 100 * 1024 * 1024  # smaller files are renamed in RAM without touching disk
+IN_MEMORY_BUDGET = int(os.getenv('IN_MEMORY_BUDGET', 256 * 1024 * 1024))  # RAM all in-memory renames may hold at once
 CLEANUP_INTERVAL = 300  # 5 minutes
+PROCESSED_MESSAGES_LIMIT = 1000
+PROCESSED_MESSAGES_TTL = 300  # seconds a message id stays in the dedup window
+SEND_CONCURRENCY = 10  # uploads in flight at once; Telegram flood-limits well below 50
+USER_CONCURRENCY = 3  # renames one user may have in flight at once
+IO_WORKERS = max(8, min(32, (os.cpu_count() or 1) * 4))  # threads for blocking disk and DB calls
+DISK_WRITE_SLOTS = IO_WORKERS // 2  # download writes in flight; the rest of the pool stays free for quick calls
+UPLOAD_RETRIES = 3  # attempts per upload when Telegram answers with FloodWait
+MAX_TRANSMISSIONS = int(os.getenv('MAX_TRANSMISSIONS', SEND_CONCURRENCY + DOWNLOAD_SEGMENTS * 2))  # Pyrogram media transfers at once
+FLUSH_INTERVAL = 2.0  # seconds between background DB writes
+PROGRESS_INTERVAL = 2.0  # minimum seconds between progress message edits
+SPEED_SAMPLE_INTERVAL = 0.25  # minimum seconds between speed samples
+MMAP_THRESHOLD = 64 * 1024  # JSON files above this are parsed straight from a memory map
+JSON_RELOAD_INTERVAL = 5.0  # seconds between mtime checks for edits made outside the bot
 FILE_MAX_AGE = 1200  # 20 minutes
 
 # Render detection
@@ -56,109 +84,497 @@ if not BOT_TOKEN or not API_ID or not API_HASH:
     sys.exit(1)
 
 # Global tracking
-bot_start_time = time.time()
-processed_messages = set()
-user_processing = {}
+bot_start_time = time.monotonic()
+processed_messages = collections.OrderedDict()
+user_slots = weakref.WeakValueDictionary()
+send_semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+flood_until = 0.0  # monotonic time before which no upload may start
+in_memory_bytes = 0  # RAM currently held by in-memory renames
 web_server_started = False
-web_server_url = ""
+web_server_url = RENDER_EXTERNAL_URL if RENDER else f"http://localhost:{PORT}"
+stats_buffer = collections.defaultdict(lambda: {"files_processed": 0, "bytes_processed": 0})
+stats_lock = threading.Lock()
+day_cache = [0.0, ""]  # [next local midnight timestamp, today's YYYY-MM-DD]
+
+# One pool behind asyncio.to_thread, aiofiles and the DB flushes. Its queue is unbounded; the only
+# bulk submitters, download writes, are bounded by disk_write_slots instead
+io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+event_loop.set_default_executor(io_executor)
+disk_write_slots = asyncio.Semaphore(DISK_WRITE_SLOTS)
 
 # Storage files
 THUMBNAIL_DB = "thumbnails.json"
 CAPTION_DB = "captions.json"
 USER_DB = "users.json"
 STATS_DB = "stats.json"
+USER_STORE_DB = "users.db"
 PREFIX_DB = "prefixes.json"
 PREFERENCES_DB = "preferences.json"
+FILE_MAPPING_DB = "file_mappings.json"  # legacy, migrated into MAPPING_STORE_DB
+MAPPING_STORE_DB = "mappings.db"
+
+# Working directories
+DOWNLOAD_DIR = "downloads"
+
+# Only the staging dir is needed up front; thumbnails/ and temp/ are created on first use
+WORK_DIRECTORIES = (DOWNLOAD_DIR,)
+
+# JSON ENCODING (orjson when available)
+def dump_json(data, indent=False):
+    """Serialize to UTF-8 bytes; indent=True gives the json.dump(indent=2) file layout"""
+    if orjson:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(data, option=option)
+    if indent:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode()
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+def parse_json(payload):
+    return orjson.loads(payload) if orjson else json.loads(payload)
 
-# Ensure directories
-for directory in ["downloads", "thumbnails", "temp"]:
-    os.makedirs(directory, exist_ok=True)
-
-def initialize_json_files():
-    files_to_create = {
-        USER_DB: {},
-        THUMBNAIL_DB: {},
-        CAPTION_DB: {},
-        PREFIX_DB: {},
-        PREFERENCES_DB: {},
-        STATS_DB: {"total_files": 0, "total_size": 0, "users_count": 0}
-    }
-    for file_path, default_data in files_to_create.items():
-        if not os.path.exists(file_path):
-            with open(file_path, 'w') as f:
-                json.dump(default_data, f, indent=2)
-            logger.info(f"Created {file_path}")
-
-initialize_json_files()
-
-# Flask Web Server
-app_web = Flask(__name__)
-
-@app_web.route('/')
-def home():
-    return jsonify({"status": "online", "bot": "ULTRA SPEED BOT"})
-
-@app_web.route('/stats')
-def stats():
-    stats_data = load_json(STATS_DB)
-    users_data = load_json(USER_DB)
+DEFAULT_JSON_FILES = {
+    THUMBNAIL_DB: {},
+    CAPTION_DB: {},
+    PREFIX_DB: {},
+    PREFERENCES_DB: {},
+    STATS_DB: {"total_files": 0, "total_size": 0, "users_count": 0}
+}
+
+def ensure_json_file(file_path, default_data):
+    if not os.path.exists(file_path):
+        with open(file_path, 'wb') as f:
+            f.write(dump_json(default_data, indent=True))
+        logger.info(f"Created {file_path}")
+
+async def initialize_storage():
+    """Create work directories and default JSON DBs concurrently before the bot starts"""
+    await asyncio.gather(
+        *(asyncio.to_thread(os.makedirs, directory, exist_ok=True) for directory in WORK_DIRECTORIES),
+        *(asyncio.to_thread(ensure_json_file, path, data) for path, data in DEFAULT_JSON_FILES.items())
+    )
+    # Parse every JSON DB in worker threads now so no handler pays for the first read on the loop
+    await asyncio.gather(*(asyncio.to_thread(store.preload) for store in JSON_STORES))
+
+# Web Server (aiohttp on the bot's own event loop)
+def json_response(payload):
+    return web.Response(body=dump_json(payload), content_type="application/json")
+
+async def home(request):
+    return json_response({"status": "online", "bot": "ULTRA SPEED BOT"})
+
+async def stats(request):
+    total_files, _ = get_total_stats()
+    total_users = await asyncio.to_thread(user_store.count)
     
-    uptime = time.time() - bot_start_time
-    return jsonify({
+    uptime = time.monotonic() - bot_start_time
+    return json_response({
         "status": "online",
         "uptime_seconds": int(uptime),
-        "total_files_processed": stats_data.get("total_files", 0),
-        "total_users": len(users_data),
+        "total_files_processed": total_files,
+        "total_users": total_users,
         "server_time": datetime.now().isoformat()
     })
 
-def run_web_server():
-    global web_server_started, web_server_url
+async def start_web_server():
+    global web_server_started
     try:
-        host = '0.0.0.0'
-        web_server_url = RENDER_EXTERNAL_URL if RENDER else f"http://localhost:{PORT}"
-        app_web.run(host=host, port=PORT, debug=False, threaded=True)
+        app_web = web.Application()
+        app_web.router.add_get('/', home)
+        app_web.router.add_get('/stats', stats)
+        runner = web.AppRunner(app_web, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', PORT).start()
         web_server_started = True
     except Exception as e:
         print(f"Web server error: {e}")
 
-def start_web_server():
-    web_thread = threading.Thread(target=run_web_server, daemon=True)
-    web_thread.start()
-
 # ULTRA FAST HELPER FUNCTIONS
-def load_json(file_path):
+def read_json_file(file_path):
     try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            if orjson and os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+                # Parse the mapped pages directly instead of copying the file into a bytes object
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    return orjson.loads(view)
+            return parse_json(f.read())
     except:
         return {}
 
-def save_json(file_path, data):
+def write_json_file(file_path, payload):
     try:
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=2)
+        # Write to a temp file and swap it in so readers never see a partial file
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, file_path)
         return True
     except:
         return False
 
+def write_binary_file(file_path, payload):
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(payload)
+
+# JSON STORES (in-memory, written back by flush_loop)
+class JsonStore:
+    """One JSON DB kept in memory; set/delete mark it dirty and flush() writes it back"""
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.dirty = False
+        self.flushing = False
+        self.mtime = None
+        self.next_check = 0.0
+        self.lock = threading.Lock()
+    
+    def file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+    
+    def loaded(self):
+        # Caller holds self.lock
+        if self.data is None:
+            self.mtime = self.file_mtime()
+            self.data = read_json_file(self.path)
+        elif not self.dirty and not self.flushing:
+            # Pick up edits made to the file by hand, checking the mtime at most every JSON_RELOAD_INTERVAL
+            now = time.monotonic()
+            if now >= self.next_check:
+                self.next_check = now + JSON_RELOAD_INTERVAL
+                mtime = self.file_mtime()
+                if mtime != self.mtime:
+                    self.mtime = mtime
+                    self.data = read_json_file(self.path)
+        return self.data
+    
+    def preload(self):
+        with self.lock:
+            self.loaded()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            return self.loaded().get(key, default)
+    
+    def set(self, key, value):
+        with self.lock:
+            self.loaded()[key] = value
+            self.dirty = True
+        return True
+    
+    def delete(self, key):
+        with self.lock:
+            if self.loaded().pop(key, None) is None:
+                return False
+            self.dirty = True
+        return True
+    
+    def flush(self):
+        """Write the file once if anything changed since the last flush"""
+        with self.lock:
+            if not self.dirty:
+                return True
+            # Compact: these files are only read back by the bot
+            payload = dump_json(self.data)
+            self.dirty = False
+            self.flushing = True
+        written = write_json_file(self.path, payload)
+        with self.lock:
+            self.flushing = False
+            if written:
+                # Our own write must not look like an outside edit
+                self.mtime = self.file_mtime()
+            else:
+                self.dirty = True
+        if not written:
+            logger.error(f"Failed to write {self.path}, retrying on next flush")
+        return written
+
+thumbnail_store = JsonStore(THUMBNAIL_DB)
+caption_store = JsonStore(CAPTION_DB)
+prefix_store = JsonStore(PREFIX_DB)
+preferences_store = JsonStore(PREFERENCES_DB)
+stats_store = JsonStore(STATS_DB)
+JSON_STORES = (thumbnail_store, caption_store, prefix_store, preferences_store, stats_store)
+
+def flush_json():
+    """Write every modified JSON DB once"""
+    for store in JSON_STORES:
+        store.flush()
+
+# USER STORE (SQLite, WAL mode)
+UserRecord = collections.namedtuple("UserRecord", ["files_processed", "total_size", "last_active", "joined"])
+
+class UserStore:
+    """Per-user counters kept in SQLite so an update touches one row instead of rewriting users.json"""
+    def __init__(self, db_path, legacy_json=None):
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.db_lock = threading.Lock()  # guards the connection
+        self.lock = threading.Lock()  # guards pending
+        self.pending = {}
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users("
+            "uid INTEGER PRIMARY KEY, last_active REAL, files INTEGER DEFAULT 0, "
+            "size INTEGER DEFAULT 0, joined REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS users_last_active ON users(last_active)")
+        self.user_count = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        if legacy_json and os.path.exists(legacy_json) and self.user_count == 0:
+            self.migrate_json(legacy_json)
+            self.user_count = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    
+    def migrate_json(self, json_path):
+        """One-time import of the old users.json records"""
+        def to_ts(value):
+            try:
+                return datetime.fromisoformat(value).timestamp()
+            except:
+                return time.time()
+        
+        rows = []
+        for user_id_str, data in read_json_file(json_path).items():
+            try:
+                rows.append((
+                    int(user_id_str),
+                    to_ts(data.get("last_active")),
+                    data.get("files_processed", 0),
+                    data.get("total_size", 0),
+                    to_ts(data.get("joined_at"))
+                ))
+            except (ValueError, AttributeError):
+                continue
+        with self.db_lock:
+            self.conn.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?)", rows)
+        if rows:
+            logger.info(f"Migrated {len(rows)} users from {json_path}")
+    
+    def update_user_activity(self, user_id, files_processed=0, total_size=0):
+        """Record activity in memory; flush() writes all pending users in one transaction"""
+        now = time.time()
+        with self.lock:
+            entry = self.pending.get(user_id)
+            if entry is None:
+                self.pending[user_id] = [now, now, files_processed, total_size]
+            else:
+                entry[1] = now
+                entry[2] += files_processed
+                entry[3] += total_size
+    
+    def flush(self):
+        # db_lock keeps batches committing in the order they were taken; self.lock is only held for the swap,
+        # so update_user_activity on the event loop never waits for SQLite
+        with self.db_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                pending = self.pending
+                self.pending = {}
+            new_users = 0
+            self.conn.execute("BEGIN")
+            try:
+                for uid, (joined, last_active, files, size) in pending.items():
+                    cursor = self.conn.execute(
+                        "INSERT OR IGNORE INTO users(uid, last_active, files, size, joined) VALUES (?, ?, ?, ?, ?)",
+                        (uid, last_active, files, size, joined)
+                    )
+                    if cursor.rowcount:
+                        new_users += 1
+                    else:
+                        self.conn.execute(
+                            "UPDATE users SET last_active=?, files=files+?, size=size+? WHERE uid=?",
+                            (last_active, files, size, uid)
+                        )
+                self.conn.execute("COMMIT")
+                self.user_count += new_users
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                self.restore_pending(pending)
+                raise
+    
+    def restore_pending(self, pending):
+        """Merge a failed batch back under activity recorded since it was taken"""
+        with self.lock:
+            for uid, (joined, last_active, files, size) in pending.items():
+                entry = self.pending.get(uid)
+                if entry is None:
+                    self.pending[uid] = [joined, last_active, files, size]
+                else:
+                    entry[0] = min(entry[0], joined)
+                    entry[1] = max(entry[1], last_active)
+                    entry[2] += files
+                    entry[3] += size
+    
+    def get(self, user_id):
+        """Return the user's UserRecord (zeroed if unknown)"""
+        self.flush()
+        with self.db_lock:
+            row = self.conn.execute(
+                "SELECT files, size, last_active, joined FROM users WHERE uid=?", (user_id,)
+            ).fetchone()
+        return UserRecord(*row) if row else UserRecord(0, 0, 0.0, 0.0)
+    
+    def count(self):
+        """Total users, from a running counter instead of a table scan"""
+        self.flush()
+        return self.user_count
+
+user_store = UserStore(USER_STORE_DB, legacy_json=USER_DB)
+
+# FILE MAPPING STORE (SQLite, WAL mode)
+class FileMappingStore:
+    """Rename key -> uploaded Telegram file id; grows with every upload, so indexed rows instead of one JSON blob"""
+    def __init__(self, db_path, legacy_json=None):
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.db_lock = threading.Lock()  # guards the connection
+        self.lock = threading.Lock()  # guards pending
+        self.pending = {}
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files(key TEXT PRIMARY KEY, file_id TEXT NOT NULL, created REAL)"
+        )
+        if legacy_json and os.path.exists(legacy_json):
+            empty = self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+            if empty:
+                self.migrate_json(legacy_json)
+    
+    def migrate_json(self, json_path):
+        """One-time import of the old file_mappings.json records"""
+        now = time.time()
+        rows = [(key, file_id, now) for key, file_id in read_json_file(json_path).items() if isinstance(file_id, str)]
+        with self.db_lock:
+            self.conn.executemany("INSERT OR IGNORE INTO files VALUES (?, ?, ?)", rows)
+        if rows:
+            logger.info(f"Migrated {len(rows)} file mappings from {json_path}")
+    
+    def get(self, key):
+        with self.lock:
+            file_id = self.pending.get(key)
+        if file_id is None:
+            # A batch being flushed has left pending; db_lock makes this wait for its COMMIT
+            with self.db_lock:
+                row = self.conn.execute("SELECT file_id FROM files WHERE key=?", (key,)).fetchone()
+            file_id = row[0] if row else None
+        return file_id
+    
+    def set(self, key, file_id):
+        """Buffer in memory; flush() writes all pending mappings in one transaction"""
+        with self.lock:
+            self.pending[key] = file_id
+        return True
+    
+    def flush(self):
+        # Same locking as UserStore.flush: only the swap holds self.lock, so set() and get() never wait on SQLite
+        with self.db_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                pending = self.pending
+                self.pending = {}
+            now = time.time()
+            rows = [(key, file_id, now) for key, file_id in pending.items()]
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                with self.lock:
+                    # Mappings saved since the batch was taken are newer; keep them
+                    for key, file_id in pending.items():
+                        self.pending.setdefault(key, file_id)
+                raise
+
+file_mapping_store = FileMappingStore(MAPPING_STORE_DB, legacy_json=FILE_MAPPING_DB)
+
+# BUFFERED STATS
+def today_key():
+    """Local date as YYYY-MM-DD, recomputed only after midnight"""
+    if time.time() >= day_cache[0]:
+        today = datetime.now()
+        day_cache[1] = today.strftime("%Y-%m-%d")
+        # Next local midnight from the calendar, not +86400: DST days are 23 or 25 hours long
+        day_cache[0] = datetime.combine(today.date() + timedelta(days=1), datetime.min.time()).timestamp()
+    return day_cache[1]
+
+def update_stats(files_processed=0, bytes_processed=0):
+    """Count a transfer in memory; flush_stats() merges it into STATS_DB"""
+    today = today_key()
+    with stats_lock:
+        day = stats_buffer[today]
+        day["files_processed"] += files_processed
+        day["bytes_processed"] += bytes_processed
+
+def record_rename(user_id, file_size):
+    """Count one finished rename in the global and per-user buffers together"""
+    update_stats(files_processed=1, bytes_processed=file_size)
+    user_store.update_user_activity(user_id, files_processed=1, total_size=file_size)
+
+def flush_stats():
+    """Merge buffered counters into the cached STATS_DB"""
+    with stats_lock:
+        if not stats_buffer:
+            return True
+        pending = dict(stats_buffer)
+        stats_buffer.clear()
+        # One store lock and one dict binding for the whole merge
+        with stats_store.lock:
+            stats = stats_store.loaded()
+            for today, counts in pending.items():
+                files, size = counts["files_processed"], counts["bytes_processed"]
+                stats["total_files"] = stats.get("total_files", 0) + files
+                stats["total_size"] = stats.get("total_size", 0) + size
+                day = stats.setdefault(today, {"files_processed": 0, "bytes_processed": 0})
+                day["files_processed"] += files
+                day["bytes_processed"] += size
+            stats_store.dirty = True
+        return True
+
+def get_total_stats():
+    """Return (total_files, total_size) including not yet flushed counters"""
+    with stats_lock:
+        total_files = stats_store.get("total_files", 0)
+        total_size = stats_store.get("total_size", 0)
+        for counts in stats_buffer.values():
+            total_files += counts["files_processed"]
+            total_size += counts["bytes_processed"]
+    return total_files, total_size
+
+def flush_all():
+    # A failing store must not hold back the others; each keeps its batch for the next cycle
+    for flush in (flush_stats, flush_json, user_store.flush, file_mapping_store.flush):
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Flush error in {flush.__qualname__}: {e}")
+
+async def flush_loop():
+    """Write buffered stats and modified JSON DBs at most once per FLUSH_INTERVAL"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            # Serialization, file writes and the SQLite commit all run in a worker thread
+            await asyncio.to_thread(flush_all)
+        except Exception as e:
+            logger.error(f"Background flush error: {e}")
+
+atexit.register(flush_all)
+
 def get_user_prefix(user_id):
-    prefixes = load_json(PREFIX_DB)
-    return prefixes.get(str(user_id), "")
+    return prefix_store.get(str(user_id), "")
 
 def set_user_prefix(user_id, prefix):
-    prefixes = load_json(PREFIX_DB)
-    prefixes[str(user_id)] = prefix
-    return save_json(PREFIX_DB, prefixes)
+    return prefix_store.set(str(user_id), prefix)
 
 def get_upload_mode(user_id):
-    preferences = load_json(PREFERENCES_DB)
-    return preferences.get(str(user_id), "auto")
+    return preferences_store.get(str(user_id), "auto")
 
 def set_upload_mode(user_id, mode):
-    preferences = load_json(PREFERENCES_DB)
-    preferences[str(user_id)] = mode
-    return save_json(PREFERENCES_DB, preferences)
+    return preferences_store.set(str(user_id), mode)
 
 def sanitize_filename(filename):
     """Sanitize filename to prevent path traversal and invalid characters"""
@@ -176,70 +592,147 @@ def sanitize_filename(filename):
     return filename.strip()
 
 # THUMBNAIL MANAGEMENT FUNCTIONS
+def get_thumbnail_entry(user_id):
+    """Get user's thumbnail record: {"path": local file, "file_id": Telegram file id}"""
+    entry = thumbnail_store.get(str(user_id))
+    if isinstance(entry, str):
+        # Records written before file ids were cached
+        return {"path": entry, "file_id": None}
+    return entry
+
+def file_present(file_path):
+    """One stat call; missing or unreadable paths count as absent"""
+    try:
+        os.stat(file_path)
+        return True
+    except OSError:
+        return False
+
 def get_user_thumbnail(user_id):
     """Get user's thumbnail path"""
-    thumbnails = load_json(THUMBNAIL_DB)
-    thumbnail_path = thumbnails.get(str(user_id))
-    if thumbnail_path and os.path.exists(thumbnail_path):
-        return thumbnail_path
+    entry = get_thumbnail_entry(user_id)
+    if entry and file_present(entry["path"]):
+        return entry["path"]
+    return None
+
+async def ensure_user_thumbnail(client, user_id):
+    """Get user's thumbnail path, re-fetching it by file id if the local copy is gone"""
+    entry = get_thumbnail_entry(user_id)
+    if not entry:
+        return None
+    if await asyncio.to_thread(file_present, entry["path"]):
+        return entry["path"]
+    if entry.get("file_id"):
+        try:
+            return await client.download_media(entry["file_id"], file_name=entry["path"])
+        except Exception as e:
+            print(f"Thumbnail restore error: {e}")
     return None
 
-def set_user_thumbnail(user_id, thumbnail_path):
-    """Set user's thumbnail path"""
-    thumbnails = load_json(THUMBNAIL_DB)
-    thumbnails[str(user_id)] = thumbnail_path
-    return save_json(THUMBNAIL_DB, thumbnails)
+def set_user_thumbnail(user_id, thumbnail_path, file_id=None):
+    """Set user's thumbnail path and its Telegram file id"""
+    return thumbnail_store.set(str(user_id), {"path": thumbnail_path, "file_id": file_id})
 
 def delete_user_thumbnail(user_id):
     """Delete user's thumbnail"""
-    thumbnails = load_json(THUMBNAIL_DB)
-    user_id_str = str(user_id)
+    entry = get_thumbnail_entry(user_id)
     
-    if user_id_str in thumbnails:
+    if entry:
         # Delete the thumbnail file
-        thumbnail_path = thumbnails[user_id_str]
-        if os.path.exists(thumbnail_path):
-            try:
-                os.remove(thumbnail_path)
-            except:
-                pass
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            pass
         # Remove from database
-        del thumbnails[user_id_str]
-        return save_json(THUMBNAIL_DB, thumbnails)
+        return thumbnail_store.delete(str(user_id))
     return False
 
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
 def format_size(size_bytes):
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.2f} {unit}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.2f} TB"
+    # Speeds arrive as floats; whole bytes keep the cache keys reusable
+    return cached_format_size(int(size_bytes))
+
+@functools.lru_cache(maxsize=1024)
+def cached_format_size(size_bytes):
+    # Unit index straight from the bit length: 1024**i <= size < 1024**(i+1)
+    if size_bytes <= 0:
+        return "0.00 B"
+    i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (i * 10)):.2f} {SIZE_UNITS[i]}"
+
+# Every "00:MM:SS" string for durations under an hour
+SHORT_DURATIONS = tuple(f"00:{m:02d}:{s:02d}" for m in range(60) for s in range(60))
 
 def format_duration(seconds):
-    return f"{int(seconds//3600):02d}:{int((seconds%3600)//60):02d}:{int(seconds%60):02d}"
+    seconds = int(seconds)
+    if 0 <= seconds < 3600:
+        return SHORT_DURATIONS[seconds]
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+# CAPTION TEMPLATES
+@functools.lru_cache(maxsize=4096)
+def compile_caption(template):
+    """Tokenize a caption template once; reused for every upload with the same caption"""
+    try:
+        return tuple(string.Formatter().parse(template))
+    except ValueError:
+        # Unbalanced braces - treat the whole caption as literal text
+        return ((template, None, None, None),)
+
+def format_caption(template, **fields):
+    """Fill {filename}, {size}, {duration}, {width}, {height}; unknown placeholders become empty"""
+    values = collections.defaultdict(str, fields)
+    parts = []
+    for literal, field, spec, conversion in compile_caption(template):
+        parts.append(literal)
+        if field is None:
+            continue
+        value = values[field]
+        if conversion == "r":
+            value = repr(value)
+        elif conversion == "a":
+            value = ascii(value)
+        try:
+            parts.append(format(value, spec or ""))
+        except (ValueError, TypeError):
+            parts.append(str(value))
+    return "".join(parts)
 
 # AUTO CLEANUP SYSTEM
+def delete_old_files():
+    """Delete staged files older than FILE_MAX_AGE; scandir gives the type and one stat per entry"""
+    current_time = time.time()
+    files_deleted = 0
+    
+    for directory in ["downloads", "temp"]:
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                if not entry.is_file():
+                    continue
+                file_age = current_time - entry.stat().st_ctime
+                if file_age > FILE_MAX_AGE:
+                    os.remove(entry.path)
+                    files_deleted += 1
+                    logger.info(f"Auto-deleted: {entry.name} (age: {file_age:.1f}s)")
+            except FileNotFoundError:
+                # Already removed by its transfer's own cleanup
+                pass
+            except Exception as e:
+                logger.error(f"Cleanup error for {entry.name}: {e}")
+    return files_deleted
+
 async def auto_cleanup():
     """Automatically delete files older than 20 minutes"""
     while True:
         try:
-            current_time = time.time()
-            files_deleted = 0
-            
-            for directory in ["downloads", "temp"]:
-                if os.path.exists(directory):
-                    for filename in os.listdir(directory):
-                        filepath = os.path.join(directory, filename)
-                        if os.path.isfile(filepath):
-                            # Delete files older than 20 minutes (1200 seconds)
-                            file_age = current_time - os.path.getctime(filepath)
-                            if file_age > FILE_MAX_AGE:
-                                try:
-                                    os.remove(filepath)
-                                    files_deleted += 1
-                                    logger.info(f"Auto-deleted: {filename} (age: {file_age:.1f}s)")
-                                except Exception as e:
-                                    logger.error(f"Cleanup error for {filename}: {e}")
+            files_deleted = await asyncio.to_thread(delete_old_files)
             
             if files_deleted > 0:
                 logger.info(f"Auto-cleanup completed: {files_deleted} files deleted")
@@ -255,68 +748,105 @@ async def start_cleanup_task():
     logger.info("🔄 Auto-cleanup system started (20-minute file retention)")
 
 # ULTRA FAST PROGRESS TRACKER
+PROGRESS_HEADERS = {
+    "download": "**📥 DOWNLOADING**\n\n",
+    "upload": "**📤 UPLOADING**\n\n",
+}
+
+# Every possible progress bar, indexed by filled cells
+PROGRESS_BAR_LENGTH = 20
+PROGRESS_BARS = tuple("█" * filled + "░" * (PROGRESS_BAR_LENGTH - filled) for filled in range(PROGRESS_BAR_LENGTH + 1))
+
 class UltraFastProgress:
+    __slots__ = (
+        "total_size", "total_size_text", "operation_type", "header", "start_time",
+        "last_time", "next_tick", "last_bytes", "current_bytes", "speeds", "metrics"
+    )
+    
     def __init__(self, total_size, operation_type):
         self.total_size = total_size
+        self.total_size_text = format_size(total_size)
         self.operation_type = operation_type
-        self.start_time = time.time()
+        self.header = PROGRESS_HEADERS.get(operation_type, PROGRESS_HEADERS["upload"])
+        self.start_time = time.monotonic()
         self.last_time = self.start_time
+        self.next_tick = self.start_time + SPEED_SAMPLE_INTERVAL
         self.last_bytes = 0
         self.current_bytes = 0
-        self.speeds = []
+        self.speeds = collections.deque(maxlen=10)
+        # Filled in place by get_metrics on every edit
+        self.metrics = {
+            "percentage": 0, "current": 0, "total": total_size,
+            "speed": 0, "eta": 0, "elapsed": 0, "bar": PROGRESS_BARS[0]
+        }
         
     def update(self, current_bytes):
-        current_time = time.time()
+        """Record progress; returns True only when a new speed sample was taken"""
         self.current_bytes = current_bytes
+        current_time = time.monotonic()
+        # Most chunks stop here; the last one always samples so the average includes it
+        if current_time < self.next_tick and current_bytes < self.total_size:
+            return False
         
         time_diff = current_time - self.last_time
-        if time_diff >= 0.1:
-            bytes_diff = current_bytes - self.last_bytes
-            instant_speed = bytes_diff / time_diff
-            
-            self.speeds.append(instant_speed)
-            if len(self.speeds) > 10:
-                self.speeds.pop(0)
-            
-            self.last_bytes = current_bytes
-            self.last_time = current_time
-            
-            return self.get_metrics()
-        return None
+        if time_diff > 0:
+            self.speeds.append((current_bytes - self.last_bytes) / time_diff)
+        
+        self.last_bytes = current_bytes
+        self.last_time = current_time
+        self.next_tick = current_time + SPEED_SAMPLE_INTERVAL
+        return True
     
     def get_metrics(self):
-        elapsed = time.time() - self.start_time
+        elapsed = time.monotonic() - self.start_time
         percentage = (self.current_bytes / self.total_size) * 100 if self.total_size > 0 else 0
         
         avg_speed = sum(self.speeds) / len(self.speeds) if self.speeds else 0
         remaining = self.total_size - self.current_bytes
         eta = remaining / avg_speed if avg_speed > 0 else 0
         
-        bar_length = 20
-        filled = int(bar_length * percentage / 100)
-        bar = "█" * filled + "░" * (bar_length - filled)
-        
-        return {
-            "percentage": percentage,
-            "current": self.current_bytes,
-            "total": self.total_size,
-            "speed": avg_speed,
-            "eta": eta,
-            "elapsed": elapsed,
-            "bar": bar
-        }
+        metrics = self.metrics
+        metrics["percentage"] = percentage
+        metrics["current"] = self.current_bytes
+        metrics["speed"] = avg_speed
+        metrics["eta"] = eta
+        metrics["elapsed"] = elapsed
+        metrics["bar"] = PROGRESS_BARS[min(PROGRESS_BAR_LENGTH, int(PROGRESS_BAR_LENGTH * percentage / 100))]
+        return metrics
     
     def get_progress_text(self, filename=""):
         metrics = self.get_metrics()
-        text = f"**{'📥 DOWNLOADING' if self.operation_type == 'download' else '📤 UPLOADING'}**\n\n"
-        if filename:
-            text += f"**File:** `{filename}`\n"
-        text += f"**Progress:** {metrics['bar']} {metrics['percentage']:.1f}%\n"
-        text += f"**Size:** {format_size(metrics['current'])} / {format_size(metrics['total'])}\n"
-        text += f"**Speed:** {format_size(metrics['speed'])}/s\n"
-        text += f"**ETA:** {format_duration(metrics['eta'])}\n"
-        text += f"**Elapsed:** {format_duration(metrics['elapsed'])}"
-        return text
+        file_line = f"**File:** `{filename}`\n" if filename else ""
+        return (
+            f"{self.header}{file_line}"
+            f"**Progress:** {metrics['bar']} {metrics['percentage']:.1f}%\n"
+            f"**Size:** {format_size(metrics['current'])} / {self.total_size_text}\n"
+            f"**Speed:** {format_size(metrics['speed'])}/s\n"
+            f"**ETA:** {format_duration(metrics['eta'])}\n"
+            f"**Elapsed:** {format_duration(metrics['elapsed'])}"
+        )
+
+def make_progress_callback(status_msg, progress, filename, last_edit):
+    """Pyrogram progress callback that edits the status message at most once per PROGRESS_INTERVAL"""
+    # last_edit is a one-item list shared by every callback editing the same status message;
+    # no forced edit at 100%, the next stage or the completion text replaces it anyway
+    async def callback(current, total):
+        if not progress.update(current):
+            return
+        current_time = time.monotonic()
+        
+        if current_time - last_edit[0] >= PROGRESS_INTERVAL:
+            # Claim the slot before awaiting so concurrent segments don't edit at once
+            last_edit[0] = current_time
+            try:
+                await status_msg.edit_text(
+                    progress.get_progress_text(filename),
+                    parse_mode=ParseMode.MARKDOWN
+                )
+            except Exception as e:
+                print(f"Progress error: {e}")
+    
+    return callback
 
 # ULTRA FAST PYROGRAM CLIENT
 try:
@@ -327,7 +857,7 @@ try:
         bot_token=BOT_TOKEN,
         sleep_threshold=60,
         workers=MAX_WORKERS,
-        max_concurrent_transmissions=50,
+        max_concurrent_transmissions=MAX_TRANSMISSIONS,
         in_memory=False
     )
     print("✅ ULTRA FAST Pyrogram client initialized")
@@ -335,18 +865,109 @@ except Exception as e:
     print(f"❌ Client error: {e}")
     sys.exit(1)
 
+# IN-MEMORY BUDGET (only touched on the event loop, so no lock)
+def reserve_memory(nbytes):
+    """Claim RAM for an in-memory rename; False sends the caller to a staging file"""
+    global in_memory_bytes
+    if in_memory_bytes + nbytes > IN_MEMORY_BUDGET:
+        return False
+    in_memory_bytes += nbytes
+    return True
+
+def release_memory(nbytes):
+    global in_memory_bytes
+    in_memory_bytes -= nbytes
+
+# ULTRA FAST IN-MEMORY DOWNLOAD
+async def ultra_fast_download_to_memory(client, message, file_name, progress_callback):
+    """Download a small file into a BytesIO that can be uploaded directly"""
+    try:
+        buffer = await client.download_media(message, in_memory=True, progress=progress_callback)
+        buffer.name = file_name
+        buffer.seek(0)
+        return buffer
+    except Exception as e:
+        print(f"Download error: {e}")
+        return None
+
 # ULTRA FAST DOWNLOAD
-async def ultra_fast_download(client, message, file_path, progress_callback):
+def preallocate_file(file_path, file_size):
+    """Create file_path with file_size bytes reserved; glibc may emulate fallocate block by block"""
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT, 0o600)
     try:
-        return await client.download_media(
-            message,
-            file_name=file_path,
-            progress=progress_callback,
-            in_memory=False
-        )
+        os.posix_fallocate(fd, 0, file_size)
+    except (AttributeError, OSError):
+        pass
+    finally:
+        os.close(fd)
+
+async def ultra_fast_download(client, message, file_path, file_size, progress_callback):
+    """Download in parallel stream_media segments into a preallocated file; returns bytes written or None"""
+    total_chunks = max(1, -(-file_size // STREAM_CHUNK_SIZE))
+    segments = min(DOWNLOAD_SEGMENTS, total_chunks)
+    chunks_per_segment = -(-total_chunks // segments)
+    downloaded = 0
+    
+    async def download_segment(first_chunk):
+        nonlocal downloaded
+        pending = bytearray()
+        async with aiofiles.open(file_path, 'r+b') as f:
+            await f.seek(first_chunk * STREAM_CHUNK_SIZE)
+            async for chunk in client.stream_media(message, offset=first_chunk, limit=chunks_per_segment):
+                pending += chunk
+                downloaded += len(chunk)
+                await progress_callback(downloaded, file_size)
+                # Batch 1MB parts into CHUNK_SIZE writes: one thread hop per batch instead of per part
+                if len(pending) >= CHUNK_SIZE:
+                    async with disk_write_slots:
+                        await f.write(pending)
+                    pending.clear()
+            if pending:
+                async with disk_write_slots:
+                    await f.write(pending)
+    
+    tasks = []
+    try:
+        # Reserve the full size up front so segments never extend the file concurrently
+        await asyncio.to_thread(preallocate_file, file_path, file_size)
+        
+        tasks = [
+            asyncio.create_task(download_segment(first_chunk))
+            for first_chunk in range(0, total_chunks, chunks_per_segment)
+        ]
+        await asyncio.gather(*tasks)
+        
+        # A segment that ended early leaves a hole; never hand that on as a finished file
+        if downloaded != file_size:
+            print(f"Download error: got {downloaded} of {file_size} bytes")
+            return None
+        return downloaded
     except Exception as e:
         print(f"Download error: {e}")
         return None
+    finally:
+        # One failed segment must not leave the others streaming into a file about to be dropped
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Upload type -> (Client method, media keyword, accepts file_name/thumb)
+SENDERS = {
+    "video": ("send_video", "video", True),
+    "audio": ("send_audio", "audio", True),
+    "photo": ("send_photo", "photo", False),
+    "document": ("send_document", "document", True),
+}
+
+# FLOOD CONTROL
+def note_flood_wait(seconds):
+    global flood_until
+    flood_until = max(flood_until, time.monotonic() + seconds)
+
+async def wait_for_flood():
+    delay = flood_until - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
 
 # ULTRA FAST UPLOAD WITH THUMBNAIL SUPPORT
 async def ultra_fast_upload(client, chat_id, file_path, file_name, caption, file_type, progress_callback):
@@ -354,45 +975,115 @@ async def ultra_fast_upload(client, chat_id, file_path, file_name, caption, file
     try:
         # Get user thumbnail
         user_id = chat_id  # Assuming chat_id is user_id for private chats
-        thumbnail_path = get_user_thumbnail(user_id)
+        thumbnail_path = await ensure_user_thumbnail(client, user_id)
         
+        method_name, media_param, named = SENDERS.get(file_type, SENDERS["document"])
         upload_params = {
             "chat_id": chat_id,
-            "file_name": file_name,
+            media_param: file_path,
             "caption": caption,
             "parse_mode": ParseMode.MARKDOWN,
             "progress": progress_callback,
             "disable_notification": True
         }
+        if media_param == "video":
+            upload_params["supports_streaming"] = True
         
-        # Add thumbnail if available and file type supports it
-        if thumbnail_path and file_type in ["video", "audio", "document"]:
-            upload_params["thumb"] = thumbnail_path
+        # File name and thumbnail only apply to types that carry them
+        if named:
+            upload_params["file_name"] = file_name
+            if thumbnail_path:
+                upload_params["thumb"] = thumbnail_path
         
-        if file_type == "video":
-            return await client.send_video(video=file_path, supports_streaming=True, **upload_params)
-        elif file_type == "audio":
-            return await client.send_audio(audio=file_path, **upload_params)
-        elif file_type == "photo":
-            return await client.send_photo(photo=file_path, **upload_params)
-        else:
-            return await client.send_document(document=file_path, **upload_params)
+        send = getattr(client, method_name)
+        async with send_semaphore:
+            for attempt in range(UPLOAD_RETRIES):
+                # A FloodWait seen by any upload pauses every upload
+                await wait_for_flood()
+                try:
+                    return await send(**upload_params)
+                except FloodWait as e:
+                    note_flood_wait(e.value)
+                    if attempt == UPLOAD_RETRIES - 1:
+                        raise
+                    # In-memory files were read to the end by the failed attempt
+                    if hasattr(file_path, "seek"):
+                        file_path.seek(0)
     except Exception as e:
         print(f"Upload error: {e}")
         raise
 
+# STAGING FILES
+def create_staging_file(user_id, file_name):
+    """Return (fd, path) for a download target; fd is None when the caller must unlink path"""
+    # An unnamed O_TMPFILE inode reached through /proc is reclaimed by the kernel even if the bot is killed
+    if hasattr(os, "O_TMPFILE"):
+        try:
+            fd = os.open(DOWNLOAD_DIR, os.O_TMPFILE | os.O_RDWR, 0o600)
+            return fd, f"/proc/self/fd/{fd}"
+        except OSError:
+            # Filesystem without O_TMPFILE support
+            pass
+    tf = tempfile.NamedTemporaryFile(prefix=f"{user_id}_", suffix=f"_{file_name}", dir=DOWNLOAD_DIR, delete=False)
+    tf.close()
+    return None, tf.name
+
+def open_staging_upload(file_path, file_name):
+    """Open a staged download for upload, named so Pyrogram guesses the MIME type from file_name"""
+    # /proc/self/fd/N has no extension; Pyrogram only looks at .name for file objects
+    f = open(file_path, "rb")
+    f.raw.name = file_name
+    return f
+
+# Message attribute holding each renameable media kind
+MEDIA_TYPES = {
+    MessageMediaType.DOCUMENT: "document",
+    MessageMediaType.VIDEO: "video",
+    MessageMediaType.AUDIO: "audio",
+    MessageMediaType.PHOTO: "photo",
+}
+
+# FILE ID REUSE
+def can_resend_original(media, file_type, new_name, upload_type, has_thumbnail):
+    """True when sending the source file id gives the same result as a re-upload"""
+    # A file id resend keeps the stored name and thumbnail: fine for photos, or unchanged names without a custom thumb
+    if upload_type != file_type:
+        return False
+    if file_type == "photo":
+        return True
+    return getattr(media, "file_name", None) == new_name and not has_thumbnail
+
+# FILE MAPPING (renamed uploads reusable by Telegram file id)
+def get_file_mapping_key(user_id, file_unique_id, file_name, upload_type):
+    """Telegram's content id plus everything that changes the uploaded result"""
+    thumbnail = get_thumbnail_entry(user_id) if upload_type != "photo" else None
+    thumb_id = (thumbnail.get("file_id") or thumbnail["path"]) if thumbnail else ""
+    return f"{file_unique_id}|{file_name}|{upload_type}|{thumb_id}"
+
+def get_file_mapping(key):
+    return file_mapping_store.get(key)
+
+def save_file_mapping(key, sent_message, upload_type):
+    media = getattr(sent_message, upload_type, None) if sent_message else None
+    if media:
+        return file_mapping_store.set(key, media.file_id)
+    return False
+
 # ULTRA FAST FILE PROCESSING WITH THUMBNAIL
 async def ultra_fast_process_file(client, message: Message, target_message: Message):
     user_id = message.from_user.id
     download_path = None
+    staging_fd = None
     status_msg = None
+    memory_reserved = 0
+    upload_source = None
     
     try:
         # Parse the rename command correctly
         if message.text.startswith('/rename'):
             parts = message.text.split(" ", 1)
             if len(parts) < 2:
-                await message.reply_text("❌ Usage: `/rename new_filename.ext`")
+                await message.reply_text(RENAME_USAGE_TEXT)
                 return
             original_name = parts[1].strip()
         else:
@@ -411,24 +1102,12 @@ async def ultra_fast_process_file(client, message: Message, target_message: Mess
         new_name = user_prefix + original_name
         
         # Get file size and info
-        file_size = 0
-        file_type = "document"
-        
-        if target_message.document:
-            file_size = target_message.document.file_size or 0
-            file_type = "document"
-        elif target_message.video:
-            file_size = target_message.video.file_size or 0
-            file_type = "video"
-        elif target_message.audio:
-            file_size = target_message.audio.file_size or 0
-            file_type = "audio"
-        elif target_message.photo:
-            file_size = target_message.photo.file_size or 0
-            file_type = "photo"
-        else:
+        file_type = MEDIA_TYPES.get(target_message.media)
+        if not file_type:
             await message.reply_text("❌ Unsupported file type")
             return
+        media = getattr(target_message, file_type)
+        file_size = media.file_size or 0
         
         if file_size == 0:
             await message.reply_text("❌ Cannot get file size")
@@ -438,96 +1117,112 @@ async def ultra_fast_process_file(client, message: Message, target_message: Mess
             await message.reply_text(f"❌ File too large: {format_size(file_size)}")
             return
         
-        # Start ULTRA FAST processing
-        start_time = time.time()
-        status_msg = await message.reply_text("⚡ **INITIALIZING ULTRA FAST TRANSFER...**")
+        # Get user caption
+        caption_template = caption_store.get(str(user_id))
+        if caption_template:
+            user_caption = format_caption(
+                caption_template,
+                filename=new_name,
+                size=format_size(file_size),
+                duration=format_duration(getattr(media, "duration", 0) or 0),
+                width=getattr(media, "width", "") or "",
+                height=getattr(media, "height", "") or ""
+            )
+        else:
+            user_caption = f"**{new_name}**\n\n⚡ **Ultra Fast Upload**"
         
-        # Generate unique file path
-        timestamp = int(time.time())
-        file_hash = hashlib.md5(f"{user_id}_{timestamp}".encode()).hexdigest()[:8]
-        file_path = f"downloads/{user_id}_{file_hash}_{new_name}"
+        # Determine upload type based on user preference
+        upload_mode = get_upload_mode(user_id)
+        if upload_mode == "auto":
+            # Use original file type
+            final_upload_type = file_type
+        else:
+            final_upload_type = upload_mode
+        
+        # The record, not the local JPEG: ensure_user_thumbnail restores a missing file by its file id
+        has_thumbnail = bool(get_thumbnail_entry(user_id))
+        
+        # Same file already renamed the same way: resend it by file id, no transfer at all
+        mapping_key = get_file_mapping_key(user_id, media.file_unique_id, new_name, final_upload_type)
+        cached_file_id = await asyncio.to_thread(get_file_mapping, mapping_key)
+        if not cached_file_id and can_resend_original(media, file_type, new_name, final_upload_type, has_thumbnail):
+            # Nothing Telegram would store differently: reuse the source file id server-side
+            cached_file_id = media.file_id
+        if cached_file_id:
+            try:
+                await client.send_cached_media(
+                    message.chat.id,
+                    cached_file_id,
+                    caption=user_caption,
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                record_rename(user_id, file_size)
+                return
+            except Exception as e:
+                # File id no longer valid; fall through to a normal transfer
+                print(f"Cached resend error: {e}")
+        
+        # Start ULTRA FAST processing
+        start_time = time.monotonic()
+        # One status message; progress ticks take it from here without extra stage edits
+        status_msg = await message.reply_text("📥 **STARTING ULTRA FAST DOWNLOAD...**")
+        # One edit clock for both stages: quick renames go straight to the result
+        last_edit = [time.monotonic()]
         
         # ULTRA FAST DOWNLOAD
         download_progress = UltraFastProgress(file_size, "download")
-        last_update = 0
-        
-        async def download_callback(current, total):
-            nonlocal last_update
-            metrics = download_progress.update(current)
-            current_time = time.time()
-            
-            if metrics and (current_time - last_update >= 1.0 or current == total):
-                try:
-                    await status_msg.edit_text(
-                        download_progress.get_progress_text(new_name),
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    last_update = current_time
-                except Exception as e:
-                    print(f"Progress error: {e}")
+        download_callback = make_progress_callback(status_msg, download_progress, new_name, last_edit)
         
-        await status_msg.edit_text("📥 **STARTING ULTRA FAST DOWNLOAD...**")
-        download_start = time.time()
-        download_path = await ultra_fast_download(client, target_message, file_path, download_callback)
-        download_time = time.time() - download_start
+        download_start = time.monotonic()
+        if file_size < IN_MEMORY_LIMIT and reserve_memory(file_size):
+            # Small files never hit the disk: download to RAM and upload the same buffer
+            memory_reserved = file_size
+            upload_source = await ultra_fast_download_to_memory(client, target_message, new_name, download_callback)
+            downloaded_size = upload_source.getbuffer().nbytes if upload_source else 0
+        else:
+            # Reserve a download target (released in finally)
+            staging_fd, download_path = create_staging_file(user_id, new_name)
+            # The byte count comes back from the download itself, no stat needed
+            downloaded_size = await ultra_fast_download(client, target_message, download_path, file_size, download_callback)
+            if downloaded_size is None:
+                upload_source = None
+            elif staging_fd is not None:
+                upload_source = await asyncio.to_thread(open_staging_upload, download_path, new_name)
+            else:
+                upload_source = download_path
+        download_time = time.monotonic() - download_start
         
-        if not download_path or not os.path.exists(download_path):
+        if not upload_source:
             await status_msg.edit_text("❌ Download failed! File not found.")
             return
         
-        downloaded_size = os.path.getsize(download_path)
         download_speed = downloaded_size / download_time if download_time > 0 else 0
         
         # ULTRA FAST UPLOAD
-        await status_msg.edit_text("🚀 **STARTING ULTRA FAST UPLOAD...**")
-        
-        # Get user caption
-        captions = load_json(CAPTION_DB)
-        user_caption = captions.get(str(user_id), f"**{new_name}**\n\n⚡ **Ultra Fast Upload**")
-        
-        # Determine upload type based on user preference
-        upload_mode = get_upload_mode(user_id)
-        if upload_mode == "auto":
-            # Use original file type
-            final_upload_type = file_type
-        else:
-            final_upload_type = upload_mode
         
         upload_progress = UltraFastProgress(downloaded_size, "upload")
-        last_upload_update = 0
-        
-        async def upload_callback(current, total):
-            nonlocal last_upload_update
-            metrics = upload_progress.update(current)
-            current_time = time.time()
-            
-            if metrics and (current_time - last_upload_update >= 1.0 or current == total):
-                try:
-                    await status_msg.edit_text(
-                        upload_progress.get_progress_text(new_name),
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    last_upload_update = current_time
-                except Exception as e:
-                    print(f"Upload progress error: {e}")
+        upload_callback = make_progress_callback(status_msg, upload_progress, new_name, last_edit)
         
-        upload_start = time.time()
+        upload_start = time.monotonic()
         
         # Perform the upload with thumbnail
         sent_message = await ultra_fast_upload(
             client, 
             message.chat.id, 
-            download_path, 
+            upload_source, 
             new_name, 
             user_caption, 
             final_upload_type, 
             upload_callback
         )
         
-        upload_time = time.time() - upload_start
+        upload_time = time.monotonic() - upload_start
         upload_speed = downloaded_size / upload_time if upload_time > 0 else 0
         
-        total_time = time.time() - start_time
+        # Remember the result for identical renames later
+        save_file_mapping(mapping_key, sent_message, final_upload_type)
+        
+        total_time = time.monotonic() - start_time
         
         # Performance rating
         avg_speed_mb = ((download_speed + upload_speed) / 2) / (1024 * 1024)
@@ -539,36 +1234,24 @@ async def ultra_fast_process_file(client, message: Message, target_message: Mess
             speed_rating = "📊 NORMAL"
         
         # Check if thumbnail was used
-        thumbnail_used = "✅" if get_user_thumbnail(user_id) and final_upload_type in ["video", "audio", "document"] else "❌"
+        thumbnail_used = "✅" if has_thumbnail and final_upload_type in ["video", "audio", "document"] else "❌"
         
         await status_msg.edit_text(
-            f"✅ **{speed_rating} TRANSFER COMPLETE!**\n\n"
-            f"📁 **File:** `{new_name}`\n"
-            f"📦 **Size:** {format_size(downloaded_size)}\n"
-            f"⏱ **Total Time:** {format_duration(total_time)}\n\n"
-            f"📥 **Download:** {format_size(download_speed)}/s\n"
-            f"📤 **Upload:** {format_size(upload_speed)}/s\n"
-            f"🔧 **Mode:** {final_upload_type.upper()}\n"
-            f"🖼️ **Thumbnail:** {thumbnail_used}\n"
-            f"🏷️ **Prefix:** {'✅' if user_prefix else '❌'}\n\n"
-            f"**Status:** ⚡ **RENAME SUCCESSFUL**"
+            TRANSFER_COMPLETE_TEXT_TEMPLATE.format(
+                speed_rating=speed_rating,
+                name=new_name,
+                size=format_size(downloaded_size),
+                total_time=format_duration(total_time),
+                download_speed=format_size(download_speed),
+                upload_speed=format_size(upload_speed),
+                mode=final_upload_type.upper(),
+                thumbnail=thumbnail_used,
+                prefix='✅' if user_prefix else '❌'
+            )
         )
         
-        # Update stats
-        stats = load_json(STATS_DB)
-        stats["total_files"] = stats.get("total_files", 0) + 1
-        stats["total_size"] = stats.get("total_size", 0) + downloaded_size
-        save_json(STATS_DB, stats)
-        
-        # Update user stats
-        users = load_json(USER_DB)
-        user_id_str = str(user_id)
-        if user_id_str not in users:
-            users[user_id_str] = {"files_processed": 0, "total_size": 0, "joined_at": datetime.now().isoformat()}
-        users[user_id_str]["files_processed"] = users[user_id_str].get("files_processed", 0) + 1
-        users[user_id_str]["total_size"] = users[user_id_str].get("total_size", 0) + downloaded_size
-        users[user_id_str]["last_active"] = datetime.now().isoformat()
-        save_json(USER_DB, users)
+        # Update global and user stats
+        record_rename(user_id, downloaded_size)
         
     except FloodWait as e:
         wait_msg = f"⏳ Flood wait: {e.value}s"
@@ -585,38 +1268,201 @@ async def ultra_fast_process_file(client, message: Message, target_message: Mess
         else:
             await message.reply_text(error_msg)
     finally:
-        # Cleanup downloaded file
-        if download_path and os.path.exists(download_path):
+        if memory_reserved:
+            release_memory(memory_reserved)
+        if hasattr(upload_source, "close"):
+            upload_source.close()
+        # Cleanup downloaded file; closing an O_TMPFILE descriptor frees it
+        if staging_fd is not None:
+            os.close(staging_fd)
+        elif download_path:
             try:
-                os.remove(download_path)
+                await aiofiles.os.remove(download_path)
                 logger.info(f"Cleaned up: {download_path}")
+            except FileNotFoundError:
+                pass
             except Exception as e:
                 print(f"Cleanup error: {e}")
 
+# STATIC RESPONSES
+RENAME_HELP_TEXT = (
+    "❌ **How to use:**\n"
+    "1. Reply to a file with `/rename new_filename.ext`\n"
+    "2. Wait for ultra fast processing\n\n"
+    f"**Max Size:** {format_size(MAX_FILE_SIZE)}\n"
+    "**Speed:** ⚡ **INSTANT TRANSFER**"
+)
+RENAME_USAGE_TEXT = "❌ Usage: `/rename new_filename.ext`"
+SET_THUMBNAIL_HELP_TEXT = (
+    "🖼️ **SET THUMBNAIL**\n\n"
+    "To set a thumbnail:\n\n"
+    "**Method 1:** Simply send any photo to this chat\n"
+    "**Method 2:** Reply to a photo with `/setthumb` command\n\n"
+    "The thumbnail will be automatically used for your video, audio, and document uploads."
+)
+SET_PREFIX_HELP_TEXT = (
+    "🔧 **SET PREFIX**\n\n"
+    "Use `/set_prefix your_prefix` to set a custom prefix.\n\n"
+    "**Example:** `/set_prefix MOVIE_`\n\n"
+    "All renamed files will have this prefix added automatically."
+)
+SET_PREFIX_USAGE_TEXT = "❌ Usage: `/set_prefix your_prefix`"
+START_TEXT_TEMPLATE = (
+    "⚡ **ULTRA FAST RENAME BOT**\n\n"
+    "**Hello {name}!**\n\n"
+    "**Features:**\n"
+    "• ⚡ Instant file renaming\n"
+    "• 🖼️ Custom thumbnails\n"
+    "• 🚀 Parallel processing\n"
+    "• 📊 Real-time progress\n"
+    "• 📁 4GB file support\n"
+    "• 🔄 Auto-cleanup (20min)\n\n"
+    "**System:** {web_status}\n"
+    "**How to use:** Reply to any file with `/rename new_filename.ext`\n\n"
+    "**⚡ EXPERIENCE INSTANT RENAMING!**"
+)
+SETTINGS_TEXT_TEMPLATE = (
+    "🔧 **ULTRA FAST SETTINGS**\n\n"
+    "**Current Settings:**\n"
+    "• **Prefix:** `{prefix}`\n"
+    "• **Upload Mode:** {upload_mode}\n"
+    "• **Thumbnail:** {has_thumbnail}\n\n"
+    "**Commands:**\n"
+    "• `/rename filename.ext` - Rename files\n"
+    "• `/set_prefix text` - Set custom prefix\n"
+    "• `/setthumb` - Set thumbnail (reply to photo)\n"
+    "• `/viewthumb` - View current thumbnail\n"
+    "• `/delthumb` - Delete thumbnail\n\n"
+    "**Choose an option:**"
+)
+THUMBNAIL_SETTINGS_TEXT_TEMPLATE = (
+    "🖼️ **THUMBNAIL SETTINGS**\n\n"
+    "**Status:** {has_thumbnail}\n\n"
+    "**How to set:**\n"
+    "1. Send any photo to this chat\n"
+    "2. Or use /setthumb command\n\n"
+    "**Supported for:** Videos, Audio, Documents\n\n"
+    "**Choose action:**"
+)
+UPLOAD_MODE_TEXT_TEMPLATE = (
+    "📤 **UPLOAD MODE**\n\n"
+    "**Current:** {current_mode}\n\n"
+    "**Modes:**\n"
+    "• 🤖 **Auto:** Smart file type detection\n"
+    "• 📁 **Document:** Force as document file\n"
+    "• 🎥 **Video:** Force as video file\n\n"
+    "**Choose mode:**"
+)
+MODE_UPDATED_TEXT_TEMPLATE = (
+    "✅ **UPLOAD MODE UPDATED**\n\n"
+    "**New Mode:** {mode}\n\n"
+    "All future uploads will use this mode.\n"
+    "**Status:** ⚡ **OPTIMIZED FOR SPEED**"
+)
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⚡ Speed Test", callback_data="speed_test")],
+    [InlineKeyboardButton("🔧 Settings", callback_data="settings")],
+    [InlineKeyboardButton("🖼️ Thumbnail", callback_data="thumbnail_settings")],
+    [InlineKeyboardButton("🌐 Status", url=web_server_url)]
+])
+SETTINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔧 Set Prefix", callback_data="set_prefix")],
+    [InlineKeyboardButton("📤 Upload Mode", callback_data="upload_mode")],
+    [InlineKeyboardButton("🖼️ Thumbnail", callback_data="thumbnail_settings")],
+    [InlineKeyboardButton("⚡ Speed Test", callback_data="speed_test")]
+])
+THUMBNAIL_SETTINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🖼️ Set Thumbnail", callback_data="set_thumbnail")],
+    [InlineKeyboardButton("👀 View Thumbnail", callback_data="view_thumbnail")],
+    [InlineKeyboardButton("🗑️ Delete Thumbnail", callback_data="delete_thumbnail")],
+    [InlineKeyboardButton("🔙 Back", callback_data="settings")]
+])
+UPLOAD_MODE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🤖 Auto", callback_data="mode_auto")],
+    [InlineKeyboardButton("📁 Document", callback_data="mode_document")],
+    [InlineKeyboardButton("🎥 Video", callback_data="mode_video")],
+    [InlineKeyboardButton("🔙 Back", callback_data="settings")]
+])
+TRANSFER_COMPLETE_TEXT_TEMPLATE = (
+    "✅ **{speed_rating} TRANSFER COMPLETE!**\n\n"
+    "📁 **File:** `{name}`\n"
+    "📦 **Size:** {size}\n"
+    "⏱ **Total Time:** {total_time}\n\n"
+    "📥 **Download:** {download_speed}/s\n"
+    "📤 **Upload:** {upload_speed}/s\n"
+    "🔧 **Mode:** {mode}\n"
+    "🖼️ **Thumbnail:** {thumbnail}\n"
+    "🏷️ **Prefix:** {prefix}\n\n"
+    "**Status:** ⚡ **RENAME SUCCESSFUL**"
+)
+STATS_TEXT_TEMPLATE = (
+    "📊 **BOT STATISTICS**\n\n"
+    "**Global Stats:**\n"
+    "• 📁 Total Files: {total_files}\n"
+    "• 💾 Total Size: {total_size}\n"
+    "• 👥 Total Users: {total_users}\n"
+    "• ⏰ Uptime: {uptime}\n\n"
+    "**Your Stats:**\n"
+    "• 📁 Your Files: {user_files}\n"
+    "• 💾 Your Size: {user_size}\n\n"
+    f"**Auto-Cleanup:** ✅ Active ({FILE_MAX_AGE // 60} minutes)"
+)
+THUMBNAIL_DELETED_TEXT = "✅ Thumbnail deleted successfully!"
+NO_THUMBNAIL_TO_DELETE_TEXT = "❌ No thumbnail found to delete"
+
 # FIXED RENAME COMMAND
-@app.on_message(filters.command("rename"))
-async def rename_command(client, message: Message):
-    # Check if message already processed
-    if message.id in processed_messages:
-        return
-    processed_messages.add(message.id)
+def is_message_processed(key):
+    seen_at = processed_messages.get(key)
+    return seen_at is not None and time.monotonic() - seen_at < PROCESSED_MESSAGES_TTL
+
+def mark_message_processed(key):
+    """Remember a (chat_id, message_id) key; entries expire after the TTL or once the window is full"""
+    now = time.monotonic()
+    processed_messages[key] = now
+    processed_messages.move_to_end(key)
+    # Oldest entries sit at the front, so expiry stops at the first fresh one
+    expire_before = now - PROCESSED_MESSAGES_TTL
+    while processed_messages:
+        oldest_key, seen_at = next(iter(processed_messages.items()))
+        if seen_at >= expire_before and len(processed_messages) <= PROCESSED_MESSAGES_LIMIT:
+            break
+        del processed_messages[oldest_key]
+
+async def check_not_duplicate(flt, client, message):
+    """Filter body: reject redelivered updates and record user activity before a handler is scheduled"""
+    # Async so Pyrogram runs it on the event loop: the check-and-mark below stays atomic without a lock
+    key = (message.chat.id, message.id)
+    if is_message_processed(key):
+        return False
+    mark_message_processed(key)
     
+    if message.from_user:
+        user_store.update_user_activity(message.from_user.id)
+    return True
+
+# Chained last onto handler filters so it only runs for messages a handler wants
+not_duplicate = filters.create(check_not_duplicate)
+
+def get_user_slots(user_id):
+    """Per-user rename semaphore; dropped automatically once no task holds it"""
+    slots = user_slots.get(user_id)
+    if slots is None:
+        slots = asyncio.Semaphore(USER_CONCURRENCY)
+        user_slots[user_id] = slots
+    return slots
+
+async def rename_command(client, message: Message):
     user_id = message.from_user.id
     
-    # Check if user is already processing
-    if user_id in user_processing and user_processing[user_id]:
-        await message.reply_text("⏳ Please wait, processing your previous file...")
+    # Check if user already has the maximum renames running
+    slots = get_user_slots(user_id)
+    if slots.locked():
+        await message.reply_text("⏳ Please wait, processing your previous files...")
         return
     
     # Check if replying to a message
     if not message.reply_to_message:
-        await message.reply_text(
-            "❌ **How to use:**\n"
-            "1. Reply to a file with `/rename new_filename.ext`\n"
-            "2. Wait for ultra fast processing\n\n"
-            f"**Max Size:** {format_size(MAX_FILE_SIZE)}\n"
-            f"**Speed:** ⚡ **INSTANT TRANSFER**"
-        )
+        await message.reply_text(RENAME_HELP_TEXT)
         return
     
     # Check if replied message has media
@@ -624,19 +1470,14 @@ async def rename_command(client, message: Message):
         await message.reply_text("❌ Please reply to a media file (document, video, audio, photo)")
         return
     
-    # Set user as processing
-    user_processing[user_id] = True
-    
-    try:
-        await ultra_fast_process_file(client, message, message.reply_to_message)
-    except Exception as e:
-        await message.reply_text(f"❌ Processing error: {str(e)}")
-    finally:
-        # Reset processing status
-        user_processing[user_id] = False
+    # Hold one of the user's slots for the whole transfer
+    async with slots:
+        try:
+            await ultra_fast_process_file(client, message, message.reply_to_message)
+        except Exception as e:
+            await message.reply_text(f"❌ Processing error: {str(e)}")
 
 # THUMBNAIL COMMANDS
-@app.on_message(filters.command("setthumb"))
 async def set_thumbnail_command(client, message: Message):
     """Command to set thumbnail"""
     if not message.reply_to_message or not message.reply_to_message.photo:
@@ -650,38 +1491,37 @@ async def set_thumbnail_command(client, message: Message):
         await message.reply_to_message.download(thumb_path)
         
         # Set thumbnail in database
-        if set_user_thumbnail(user_id, thumb_path):
+        if set_user_thumbnail(user_id, thumb_path, message.reply_to_message.photo.file_id):
             await message.reply_text("✅ Thumbnail set successfully! It will be used for videos, audio, and documents.")
         else:
             await message.reply_text("❌ Failed to save thumbnail")
     except Exception as e:
         await message.reply_text(f"❌ Error setting thumbnail: {str(e)}")
 
-@app.on_message(filters.command("delthumb"))
 async def delete_thumbnail_command(client, message: Message):
     """Command to delete thumbnail"""
     user_id = message.from_user.id
-    if delete_user_thumbnail(user_id):
-        await message.reply_text("✅ Thumbnail deleted successfully!")
+    if await asyncio.to_thread(delete_user_thumbnail, user_id):
+        await message.reply_text(THUMBNAIL_DELETED_TEXT)
     else:
-        await message.reply_text("❌ No thumbnail found to delete")
+        await message.reply_text(NO_THUMBNAIL_TO_DELETE_TEXT)
 
-@app.on_message(filters.command("viewthumb"))
 async def view_thumbnail_command(client, message: Message):
     """Command to view current thumbnail"""
     user_id = message.from_user.id
-    thumbnail_path = get_user_thumbnail(user_id)
+    thumbnail = get_thumbnail_entry(user_id)
     
-    if thumbnail_path and os.path.exists(thumbnail_path):
+    # Reply with the cached file id so the photo isn't uploaded again
+    if thumbnail and (thumbnail.get("file_id") or await asyncio.to_thread(file_present, thumbnail["path"])):
         await message.reply_photo(
-            thumbnail_path,
+            thumbnail.get("file_id") or thumbnail["path"],
             caption="🖼️ Your current thumbnail"
         )
     else:
         await message.reply_text("❌ No thumbnail set. Use /setthumb to set one.")
 
 # AUTO THUMBNAIL FROM PHOTOS
-@app.on_message(filters.photo & filters.private)
+@app.on_message(filters.photo & filters.private & not_duplicate)
 async def auto_set_thumbnail(client, message: Message):
     """Automatically set thumbnail when user sends a photo in private chat"""
     user_id = message.from_user.id
@@ -689,7 +1529,7 @@ async def auto_set_thumbnail(client, message: Message):
         thumb_path = f"thumbnails/{user_id}.jpg"
         await message.download(thumb_path)
         
-        if set_user_thumbnail(user_id, thumb_path):
+        if set_user_thumbnail(user_id, thumb_path, message.photo.file_id):
             await message.reply_text("✅ Thumbnail set automatically from your photo! It will be used for future uploads.")
         else:
             await message.reply_text("❌ Failed to set thumbnail")
@@ -697,142 +1537,78 @@ async def auto_set_thumbnail(client, message: Message):
         await message.reply_text(f"❌ Error setting thumbnail: {str(e)}")
 
 # START COMMAND
-@app.on_message(filters.command("start"))
 async def start_command(client, message: Message):
     web_status = "✅ Running" if web_server_started else "❌ Stopped"
     
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("⚡ Speed Test", callback_data="speed_test")],
-        [InlineKeyboardButton("🔧 Settings", callback_data="settings")],
-        [InlineKeyboardButton("🖼️ Thumbnail", callback_data="thumbnail_settings")],
-        [InlineKeyboardButton("🌐 Status", url=web_server_url)]
-    ])
-    
     await message.reply_text(
-        f"⚡ **ULTRA FAST RENAME BOT**\n\n"
-        f"**Hello {message.from_user.first_name}!**\n\n"
-        f"**Features:**\n"
-        f"• ⚡ Instant file renaming\n"
-        f"• 🖼️ Custom thumbnails\n"
-        f"• 🚀 Parallel processing\n"
-        f"• 📊 Real-time progress\n"
-        f"• 📁 4GB file support\n"
-        f"• 🔄 Auto-cleanup (20min)\n\n"
-        f"**System:** {web_status}\n"
-        f"**How to use:** Reply to any file with `/rename new_filename.ext`\n\n"
-        f"**⚡ EXPERIENCE INSTANT RENAMING!**",
-        reply_markup=keyboard,
+        START_TEXT_TEMPLATE.format(name=message.from_user.first_name, web_status=web_status),
+        reply_markup=START_KEYBOARD,
         parse_mode=ParseMode.MARKDOWN
     )
 
 # SETTINGS COMMAND
-@app.on_message(filters.command("settings"))
-async def settings_command(client, message: Message):
-    user_id = message.from_user.id
+async def get_settings_text(user_id):
     prefix = get_user_prefix(user_id)
     upload_mode = get_upload_mode(user_id)
-    has_thumbnail = "✅" if get_user_thumbnail(user_id) else "❌"
-    
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔧 Set Prefix", callback_data="set_prefix")],
-        [InlineKeyboardButton("📤 Upload Mode", callback_data="upload_mode")],
-        [InlineKeyboardButton("🖼️ Thumbnail", callback_data="thumbnail_settings")],
-        [InlineKeyboardButton("⚡ Speed Test", callback_data="speed_test")]
-    ])
+    has_thumbnail = "✅" if await asyncio.to_thread(get_user_thumbnail, user_id) else "❌"
     
+    return SETTINGS_TEXT_TEMPLATE.format(
+        prefix=prefix if prefix else 'None',
+        upload_mode=upload_mode.upper(),
+        has_thumbnail=has_thumbnail
+    )
+
+async def settings_command(client, message: Message):
     await message.reply_text(
-        f"🔧 **ULTRA FAST SETTINGS**\n\n"
-        f"**Current Settings:**\n"
-        f"• **Prefix:** `{prefix if prefix else 'None'}`\n"
-        f"• **Upload Mode:** {upload_mode.upper()}\n"
-        f"• **Thumbnail:** {has_thumbnail}\n\n"
-        f"**Commands:**\n"
-        f"• `/rename filename.ext` - Rename files\n"
-        f"• `/set_prefix text` - Set custom prefix\n"
-        f"• `/setthumb` - Set thumbnail (reply to photo)\n"
-        f"• `/viewthumb` - View current thumbnail\n"
-        f"• `/delthumb` - Delete thumbnail\n\n"
-        f"**Choose an option:**",
-        reply_markup=keyboard,
+        await get_settings_text(message.from_user.id),
+        reply_markup=SETTINGS_KEYBOARD,
         parse_mode=ParseMode.MARKDOWN
     )
 
 # CALLBACK HANDLERS
-@app.on_callback_query(filters.regex("thumbnail_settings"))
 async def thumbnail_settings_callback(client, callback_query):
-    await callback_query.answer()
     user_id = callback_query.from_user.id
-    has_thumbnail = "✅ Set" if get_user_thumbnail(user_id) else "❌ Not set"
-    
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🖼️ Set Thumbnail", callback_data="set_thumbnail")],
-        [InlineKeyboardButton("👀 View Thumbnail", callback_data="view_thumbnail")],
-        [InlineKeyboardButton("🗑️ Delete Thumbnail", callback_data="delete_thumbnail")],
-        [InlineKeyboardButton("🔙 Back", callback_data="settings")]
-    ])
+    has_thumbnail = "✅ Set" if await asyncio.to_thread(get_user_thumbnail, user_id) else "❌ Not set"
     
     await callback_query.message.edit_text(
-        f"🖼️ **THUMBNAIL SETTINGS**\n\n"
-        f"**Status:** {has_thumbnail}\n\n"
-        f"**How to set:**\n"
-        f"1. Send any photo to this chat\n"
-        f"2. Or use /setthumb command\n\n"
-        f"**Supported for:** Videos, Audio, Documents\n\n"
-        f"**Choose action:**",
-        reply_markup=keyboard,
+        THUMBNAIL_SETTINGS_TEXT_TEMPLATE.format(has_thumbnail=has_thumbnail),
+        reply_markup=THUMBNAIL_SETTINGS_KEYBOARD,
         parse_mode=ParseMode.MARKDOWN
     )
 
-@app.on_callback_query(filters.regex("set_thumbnail"))
 async def set_thumbnail_callback(client, callback_query):
-    await callback_query.answer()
-    await callback_query.message.edit_text(
-        "🖼️ **SET THUMBNAIL**\n\n"
-        "To set a thumbnail:\n\n"
-        "**Method 1:** Simply send any photo to this chat\n"
-        "**Method 2:** Reply to a photo with `/setthumb` command\n\n"
-        "The thumbnail will be automatically used for your video, audio, and document uploads.",
-        parse_mode=ParseMode.MARKDOWN
-    )
+    await callback_query.message.edit_text(SET_THUMBNAIL_HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
 
-@app.on_callback_query(filters.regex("view_thumbnail"))
 async def view_thumbnail_callback(client, callback_query):
-    await callback_query.answer()
     user_id = callback_query.from_user.id
-    thumbnail_path = get_user_thumbnail(user_id)
+    thumbnail = get_thumbnail_entry(user_id)
     
-    if thumbnail_path and os.path.exists(thumbnail_path):
+    if thumbnail and (thumbnail.get("file_id") or await asyncio.to_thread(file_present, thumbnail["path"])):
         await callback_query.message.reply_photo(
-            thumbnail_path,
+            thumbnail.get("file_id") or thumbnail["path"],
             caption="🖼️ Your current thumbnail"
         )
     else:
         await callback_query.message.edit_text("❌ No thumbnail set. Send a photo to set one.")
 
-@app.on_callback_query(filters.regex("delete_thumbnail"))
 async def delete_thumbnail_callback(client, callback_query):
-    await callback_query.answer()
     user_id = callback_query.from_user.id
-    if delete_user_thumbnail(user_id):
-        await callback_query.message.edit_text("✅ Thumbnail deleted successfully!")
+    if await asyncio.to_thread(delete_user_thumbnail, user_id):
+        await callback_query.message.edit_text(THUMBNAIL_DELETED_TEXT)
     else:
-        await callback_query.message.edit_text("❌ No thumbnail found to delete")
+        await callback_query.message.edit_text(NO_THUMBNAIL_TO_DELETE_TEXT)
 
 # Other callback handlers
-@app.on_callback_query(filters.regex("speed_test"))
 async def speed_test_callback(client, callback_query):
-    await callback_query.answer()
-    
     # Simple speed test by creating and uploading a small file
     test_file_path = "temp/speed_test.bin"
     test_size = 1 * 1024 * 1024  # 1MB
     
     try:
-        # Create test file
-        with open(test_file_path, 'wb') as f:
-            f.write(os.urandom(test_size))
+        # Create test file off the event loop
+        await asyncio.to_thread(write_binary_file, test_file_path, os.urandom(test_size))
         
-        start_time = time.time()
+        start_time = time.monotonic()
         
         # Upload the file
         await client.send_document(
@@ -842,7 +1618,7 @@ async def speed_test_callback(client, callback_query):
             file_name="speed_test.bin"
         )
         
-        upload_time = time.time() - start_time
+        upload_time = time.monotonic() - start_time
         speed = test_size / upload_time
         
         await callback_query.message.edit_text(
@@ -857,74 +1633,73 @@ async def speed_test_callback(client, callback_query):
         await callback_query.message.edit_text(f"❌ Speed test failed: {str(e)}")
     finally:
         # Cleanup test file
-        if os.path.exists(test_file_path):
-            os.remove(test_file_path)
+        try:
+            await aiofiles.os.remove(test_file_path)
+        except FileNotFoundError:
+            pass
 
-@app.on_callback_query(filters.regex("settings"))
 async def settings_callback(client, callback_query):
-    await callback_query.answer()
-    await settings_command(client, callback_query.message)
-
-@app.on_callback_query(filters.regex("set_prefix"))
-async def set_prefix_callback(client, callback_query):
-    await callback_query.answer()
+    # callback_query.message was sent by the bot, so the settings belong to callback_query.from_user
     await callback_query.message.edit_text(
-        "🔧 **SET PREFIX**\n\n"
-        "Use `/set_prefix your_prefix` to set a custom prefix.\n\n"
-        "**Example:** `/set_prefix MOVIE_`\n\n"
-        "All renamed files will have this prefix added automatically.",
+        await get_settings_text(callback_query.from_user.id),
+        reply_markup=SETTINGS_KEYBOARD,
         parse_mode=ParseMode.MARKDOWN
     )
 
-@app.on_callback_query(filters.regex("upload_mode"))
+async def set_prefix_callback(client, callback_query):
+    await callback_query.message.edit_text(SET_PREFIX_HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
+
 async def upload_mode_callback(client, callback_query):
-    await callback_query.answer()
     user_id = callback_query.from_user.id
     current_mode = get_upload_mode(user_id)
     
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🤖 Auto", callback_data="mode_auto")],
-        [InlineKeyboardButton("📁 Document", callback_data="mode_document")],
-        [InlineKeyboardButton("🎥 Video", callback_data="mode_video")],
-        [InlineKeyboardButton("🔙 Back", callback_data="settings")]
-    ])
-    
     await callback_query.message.edit_text(
-        f"📤 **UPLOAD MODE**\n\n"
-        f"**Current:** {current_mode.upper()}\n\n"
-        f"**Modes:**\n"
-        f"• 🤖 **Auto:** Smart file type detection\n"
-        f"• 📁 **Document:** Force as document file\n"
-        f"• 🎥 **Video:** Force as video file\n\n"
-        f"**Choose mode:**",
-        reply_markup=keyboard,
+        UPLOAD_MODE_TEXT_TEMPLATE.format(current_mode=current_mode.upper()),
+        reply_markup=UPLOAD_MODE_KEYBOARD,
         parse_mode=ParseMode.MARKDOWN
     )
 
-@app.on_callback_query(filters.regex("mode_"))
 async def set_mode_callback(client, callback_query):
-    await callback_query.answer()
     user_id = callback_query.from_user.id
     mode = callback_query.data.split("_")[1]
     
     if set_upload_mode(user_id, mode):
         await callback_query.message.edit_text(
-            f"✅ **UPLOAD MODE UPDATED**\n\n"
-            f"**New Mode:** {mode.upper()}\n\n"
-            f"All future uploads will use this mode.\n"
-            f"**Status:** ⚡ **OPTIMIZED FOR SPEED**",
+            MODE_UPDATED_TEXT_TEMPLATE.format(mode=mode.upper()),
             parse_mode=ParseMode.MARKDOWN
         )
     else:
         await callback_query.message.edit_text("❌ Failed to update mode!")
 
+# One dict lookup per callback instead of a filter check per handler
+CALLBACK_HANDLERS = {
+    "thumbnail_settings": thumbnail_settings_callback,
+    "set_thumbnail": set_thumbnail_callback,
+    "view_thumbnail": view_thumbnail_callback,
+    "delete_thumbnail": delete_thumbnail_callback,
+    "speed_test": speed_test_callback,
+    "settings": settings_callback,
+    "set_prefix": set_prefix_callback,
+    "upload_mode": upload_mode_callback,
+    "mode_auto": set_mode_callback,
+    "mode_document": set_mode_callback,
+    "mode_video": set_mode_callback,
+}
+
+@app.on_callback_query()
+async def callback_dispatcher(client, callback_query):
+    # Every button press is answered here once, known or not
+    await callback_query.answer()
+    handler = CALLBACK_HANDLERS.get(callback_query.data)
+    if handler:
+        await handler(client, callback_query)
+
 # PREFIX COMMAND
-@app.on_message(filters.command("set_prefix"))
 async def set_prefix_command(client, message: Message):
     user_id = message.from_user.id
     
     if len(message.command) < 2:
-        await message.reply_text("❌ Usage: `/set_prefix your_prefix`")
+        await message.reply_text(SET_PREFIX_USAGE_TEXT)
         return
     
     prefix = " ".join(message.command[1:])
@@ -939,55 +1714,51 @@ async def set_prefix_command(client, message: Message):
         await message.reply_text("❌ Failed to set prefix!")
 
 # STATS COMMAND
-@app.on_message(filters.command("stats"))
 async def stats_command(client, message: Message):
-    stats_data = load_json(STATS_DB)
-    users_data = load_json(USER_DB)
-    
-    total_files = stats_data.get("total_files", 0)
-    total_size = stats_data.get("total_size", 0)
-    total_users = len(users_data)
-    uptime = time.time() - bot_start_time
+    total_files, total_size = get_total_stats()
+    # Both flush pending users first (a SQLite write), so keep them off the event loop
+    total_users = await asyncio.to_thread(user_store.count)
+    uptime = time.monotonic() - bot_start_time
     
     # Get current user stats
-    user_id = str(message.from_user.id)
-    user_files = users_data.get(user_id, {}).get("files_processed", 0)
-    user_size = users_data.get(user_id, {}).get("total_size", 0)
+    user_record = await asyncio.to_thread(user_store.get, message.from_user.id)
+    user_files = user_record.files_processed
+    user_size = user_record.total_size
     
     await message.reply_text(
-        f"📊 **BOT STATISTICS**\n\n"
-        f"**Global Stats:**\n"
-        f"• 📁 Total Files: {total_files}\n"
-        f"• 💾 Total Size: {format_size(total_size)}\n"
-        f"• 👥 Total Users: {total_users}\n"
-        f"• ⏰ Uptime: {format_duration(uptime)}\n\n"
-        f"**Your Stats:**\n"
-        f"• 📁 Your Files: {user_files}\n"
-        f"• 💾 Your Size: {format_size(user_size)}\n\n"
-        f"**Auto-Cleanup:** ✅ Active (20 minutes)",
+        STATS_TEXT_TEMPLATE.format(
+            total_files=total_files,
+            total_size=format_size(total_size),
+            total_users=total_users,
+            uptime=format_duration(uptime),
+            user_files=user_files,
+            user_size=format_size(user_size)
+        ),
         parse_mode=ParseMode.MARKDOWN
     )
 
+# One dict lookup per command instead of a filter check per handler
+COMMAND_HANDLERS = {
+    "rename": rename_command,
+    "setthumb": set_thumbnail_command,
+    "delthumb": delete_thumbnail_command,
+    "viewthumb": view_thumbnail_command,
+    "start": start_command,
+    "settings": settings_command,
+    "set_prefix": set_prefix_command,
+    "stats": stats_command,
+}
+
+@app.on_message(filters.command(list(COMMAND_HANDLERS)) & not_duplicate)
+async def command_dispatcher(client, message: Message):
+    await COMMAND_HANDLERS[message.command[0]](client, message)
+
 # CLEANUP COMMAND (ADMIN)
-@app.on_message(filters.command("cleanup") & filters.user([1340313994, 123456789]))  # Add your user ID
+@app.on_message(filters.command("cleanup") & filters.user([1340313994, 123456789]) & not_duplicate)  # Add your user ID
 async def manual_cleanup(client, message: Message):
     """Manual cleanup command for admin"""
     try:
-        files_deleted = 0
-        current_time = time.time()
-        
-        for directory in ["downloads", "temp"]:
-            if os.path.exists(directory):
-                for filename in os.listdir(directory):
-                    filepath = os.path.join(directory, filename)
-                    if os.path.isfile(filepath):
-                        file_age = current_time - os.path.getctime(filepath)
-                        if file_age > FILE_MAX_AGE:
-                            try:
-                                os.remove(filepath)
-                                files_deleted += 1
-                            except Exception as e:
-                                logger.error(f"Manual cleanup error: {e}")
+        files_deleted = await asyncio.to_thread(delete_old_files)
         
         await message.reply_text(f"✅ Manual cleanup completed: {files_deleted} files deleted")
         
@@ -1000,6 +1771,7 @@ async def main():
     print("🚀 Performance Optimizations:")
     print(f"   • Chunk Size: {format_size(CHUNK_SIZE)}")
     print(f"   • Workers: {MAX_WORKERS}")
+    print(f"   • Transmissions: {MAX_TRANSMISSIONS}")
     print(f"   • Max File: {format_size(MAX_FILE_SIZE)}")
     print("   • Instant Progress Updates")
     print("   • Real-time Speed Tracking")
@@ -1007,8 +1779,11 @@ async def main():
     print("   • File Renaming Fixed")
     print("   • Auto-Cleanup: 20 minutes")
     
+    # Prepare directories and DB files
+    await initialize_storage()
+    
     # Start web server
-    start_web_server()
+    await start_web_server()
     
     print(f"🌐 Web Dashboard: {web_server_url}")
     print("⚡ ULTRA FAST RENAME BOT READY!")
@@ -1019,16 +1794,19 @@ async def main():
     # Start cleanup task
     await start_cleanup_task()
     
-    # Start the bot
-    await app.start()
-    print("🤖 Bot is running...")
+    # Start background DB writer
+    asyncio.create_task(flush_loop())
     
-    # Keep the bot running
-    await asyncio.Event().wait()
+    # Start the bot
+    async with app:
+        print("🤖 Bot is running...")
+        
+        # Keep the bot running until SIGINT/SIGTERM
+        await idle()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        event_loop.run_until_complete(main())
     except KeyboardInterrupt:
         print("❌ Bot stopped by user")
     except Exception as e:
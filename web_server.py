@@ -1,23 +1,71 @@
 from flask import Flask, render_template, jsonify
-import json
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib decoder
+    orjson = None
+    import json
+import sqlite3
 import time
 import psutil
 import os
-from datetime import datetime
+import mmap
+from datetime import datetime, timedelta
 import threading
 
 app = Flask(__name__)
 
 # Global variables
 BOT_START_TIME = time.time()
+USER_STORE_DB = 'users.db'
+MMAP_THRESHOLD = 64 * 1024  # JSON files above this are parsed straight from a memory map
+SYSTEM_STATS_TTL = 5  # seconds a psutil snapshot is reused
+process = psutil.Process()
+system_stats_cache = [0.0, None]
+day_cache = [0.0, ""]  # [next local midnight timestamp, today's YYYY-MM-DD]
 
 def load_json(file_path):
     try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            if orjson and os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    return orjson.loads(view)
+            payload = f.read()
+        return orjson.loads(payload) if orjson else json.loads(payload)
     except:
         return {}
 
+def query_users(sql, params=()):
+    """Read-only query against the bot's SQLite user store"""
+    try:
+        conn = sqlite3.connect(f'file:{USER_STORE_DB}?mode=ro', uri=True)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return []
+
+def today_key():
+    """Local date as YYYY-MM-DD, recomputed only after midnight"""
+    if time.time() >= day_cache[0]:
+        today = datetime.now()
+        day_cache[1] = today.strftime("%Y-%m-%d")
+        # Next local midnight from the calendar, not +86400: DST days are 23 or 25 hours long
+        day_cache[0] = datetime.combine(today.date() + timedelta(days=1), datetime.min.time()).timestamp()
+    return day_cache[1]
+
+def get_system_stats():
+    """psutil memory/cpu/disk snapshot, refreshed at most every SYSTEM_STATS_TTL seconds"""
+    now = time.monotonic()
+    if system_stats_cache[1] is None or now - system_stats_cache[0] >= SYSTEM_STATS_TTL:
+        system_stats_cache[1] = (
+            process.memory_info().rss / 1024 / 1024,
+            psutil.cpu_percent(),
+            psutil.disk_usage('.')
+        )
+        system_stats_cache[0] = now
+    return system_stats_cache[1]
+
 def get_uptime():
     uptime_seconds = int(time.time() - BOT_START_TIME)
     days = uptime_seconds // 86400
@@ -43,31 +91,23 @@ def dashboard():
 @app.route('/api/stats')
 def get_stats():
     # System stats
-    process = psutil.Process()
-    memory_usage = process.memory_info().rss / 1024 / 1024
-    cpu_usage = psutil.cpu_percent()
-    disk_usage = psutil.disk_usage('.')
+    memory_usage, cpu_usage, disk_usage = get_system_stats()
     
     # Bot stats
-    users = load_json('users.json')
     stats = load_json('stats.json')
     
-    total_users = len(users)
-    
     # Active users (last 24 hours)
     day_ago = datetime.now().timestamp() - (24 * 60 * 60)
-    active_users = sum(
-        1 for user_data in users.values() 
-        if datetime.fromisoformat(user_data["last_active"]).timestamp() > day_ago
+    rows = query_users(
+        "SELECT COUNT(*), COUNT(CASE WHEN last_active > ? THEN 1 END), COALESCE(SUM(files), 0) FROM users",
+        (day_ago,)
     )
+    total_users, active_users, total_files = rows[0] if rows else (0, 0, 0)
     
     # Today's stats
-    today = datetime.now().strftime("%Y-%m-%d")
+    today = today_key()
     today_stats = stats.get(today, {"files_processed": 0, "bytes_processed": 0})
     
-    # Total files processed
-    total_files = sum(user.get("files_processed", 0) for user in users.values())
-    
     # Recent activity (last 7 days)
     recent_activity = {}
     for i in range(7):
@@ -97,22 +137,18 @@ def get_stats():
 
 @app.route('/api/users')
 def get_users():
-    users = load_json('users.json')
-    
-    # Sort users by last activity
-    sorted_users = sorted(
-        users.items(),
-        key=lambda x: datetime.fromisoformat(x[1]['last_active']),
-        reverse=True
-    )[:50]  # Show only last 50 users
+    # Most recently active users first
+    rows = query_users(
+        "SELECT uid, joined, last_active, files FROM users ORDER BY last_active DESC LIMIT 50"  # Show only last 50 users
+    )
     
     user_list = []
-    for user_id, user_data in sorted_users:
+    for user_id, joined, last_active, files_processed in rows:
         user_list.append({
-            'user_id': user_id,
-            'joined_at': user_data['joined_at'],
-            'last_active': user_data['last_active'],
-            'files_processed': user_data.get('files_processed', 0)
+            'user_id': str(user_id),
+            'joined_at': datetime.fromtimestamp(joined).isoformat(),
+            'last_active': datetime.fromtimestamp(last_active).isoformat(),
+            'files_processed': files_processed
         })
     
     return jsonify(user_list)